@@ -0,0 +1,92 @@
+import queue
+import atexit
+import logging
+import threading
+from time import monotonic
+from typing import Callable, Optional
+from django.db import close_old_connections
+from pymongo.collection import Collection
+from .models import chatlog
+
+
+class ChatlogBatcher:
+    """
+    Coalesces chat log writes and flushes them in batches from a background thread.
+
+    Each batch is written with a single chatlog.objects.bulk_create() and a single unordered
+    insert_many() on the MongoDB chat log collection, instead of one INSERT per chat.
+
+    Parameters:
+        get_collection (Callable[[], Collection]): Returns the MongoDB collection the chat documents are written to.
+        max_batch (int): Maximum number of entries per flush. Default is 50.
+        max_wait (float): Maximum number of seconds an entry waits before being flushed. Default is 0.1.
+
+    Example:
+        >>> batcher = ChatlogBatcher(get_chatlog_collection)
+        >>> batcher.put(chatlog(session_id='abc', username='user', prompt='Hi', response='Hello!'), chain_resp)
+    """
+    def __init__(self, get_collection: Callable[[], Collection], max_batch: int = 50, max_wait: float = 0.1):
+        self.get_collection = get_collection
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def put(self, row: chatlog, document: Optional[dict] = None) -> None:
+        """Queues a chatlog row, and optionally its MongoDB document, for the next batch."""
+        self._start()
+        self._queue.put((row, document))
+
+    def flush(self) -> None:
+        """Writes out everything currently queued."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._write(batch)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chatlog-batcher', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._write(self._drain())
+
+    def _drain(self) -> list:
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> None:
+        if not batch:
+            return
+        # The batcher thread outlives requests, so stale or broken database connections are dropped around each write
+        close_old_connections()
+        try:
+            chatlog.objects.bulk_create([row for row, _ in batch])
+        except Exception as e:
+            logging.error(f'CHATLOG_BATCHER bulk_create: {e}')
+        finally:
+            close_old_connections()
+
+        documents = [document for _, document in batch if document is not None]
+        if documents:
+            try:
+                self.get_collection().insert_many(documents, ordered=False)
+            except Exception as e:
+                logging.error(f'CHATLOG_BATCHER insert_many: {e}')
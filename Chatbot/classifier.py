@@ -0,0 +1,130 @@
+import os
+import logging
+import threading
+from typing import Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+# Labeled example questions per 'class label'-'sub_class label', matching the classes in classification_template
+EXEMPLARS = {
+    'query-greetings': [
+        "Hi",
+        "Hello there!",
+        "Good morning",
+        "Hey, how are you?",
+        "Thanks, bye!",
+    ],
+    'query-product_query': [
+        "Tell me about Honey Bunches of Oats cereal",
+        "What is the price of Grape-Nuts?",
+        "What are the ingredients in Fruity Pebbles?",
+        "Is Raisin Bran gluten free?",
+        "What size does Weetabix come in?",
+        "How much protein is in Premier Protein cereal?",
+        "Does Malt-O-Meal contain nuts?",
+    ],
+    'query-company_related_query': [
+        "What is Post Consumer Brands?",
+        "Which brands does Post Consumer Brands own?",
+        "Where is Post Consumer Brands headquartered?",
+        "How can I contact Post Consumer Brands customer service?",
+        "What are your customer support hours?",
+    ],
+    'complaint-create_ticket': [
+        "The cereal box I bought was damaged",
+        "I found something strange in my cereal and want to file a complaint",
+        "My order arrived late and the product was stale",
+        "I want to report a quality issue with my Honey Bunches of Oats",
+        "I'd like to raise a complaint",
+    ],
+    'complaint-view_ticket': [
+        "What is the status of my complaint?",
+        "Can I see my open cases?",
+        "Show me my support tickets",
+        "Has my complaint been resolved?",
+    ],
+    'complaint-update_ticket': [
+        "I want to update my complaint",
+        "Please change the phone number on my case",
+        "Can I add more details to my existing ticket?",
+        "Update the description of my case",
+    ],
+    'order-create_order': [
+        "I want to order two boxes of Raisin Bran",
+        "Can I buy Grape-Nuts from you?",
+        "Place an order for Pebbles cereal",
+    ],
+    'order-view_order': [
+        "Where is my order?",
+        "Show me my recent orders",
+        "Track my order",
+    ],
+    'order-update_order': [
+        "I want to change the delivery address of my order",
+        "Can I add another item to my order?",
+        "Update the quantity in my order",
+    ],
+    'order-cancel_order': [
+        "Cancel my order",
+        "I don't want my order anymore, please cancel it",
+        "How do I cancel an order I placed?",
+    ],
+    'tangential-unrelated': [
+        "What's the weather like today?",
+        "Who won the football game last night?",
+        "Write me a poem about the ocean",
+        "What is the capital of France?",
+        "Can you help me with my math homework?",
+    ],
+}
+
+_lock = threading.Lock()
+_labels = None
+_exemplar_matrix = None
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+def _load_exemplars(embeddings: Embeddings) -> tuple[list[str], np.ndarray]:
+    global _labels, _exemplar_matrix
+    with _lock:
+        if _exemplar_matrix is None:
+            labels = [label for label, texts in EXEMPLARS.items() for _ in texts]
+            texts = [text for label_texts in EXEMPLARS.values() for text in label_texts]
+            _exemplar_matrix = _normalize(np.asarray(embeddings.embed_documents(texts), dtype=np.float32))
+            _labels = labels
+    return _labels, _exemplar_matrix
+
+def classify(query: str, embeddings: Embeddings,
+             threshold: float = float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', 0.6))) -> Optional[list[str]]:
+    """
+    Classifies a query by its nearest labeled exemplar in embedding space, without an LLM call.
+
+    The exemplars are embedded once, on first use, with a single embed_documents() call.
+
+    Parameters:
+        query (str): The query to be classified.
+        embeddings (Embeddings): The embeddings model used for the exemplars and the query.
+        threshold (float): Minimum cosine similarity to the nearest exemplar for the label to be trusted. Default is os.getenv('LOCAL_CLASSIFIER_THRESHOLD') or 0.6.
+
+    Returns:
+        Optional[list[str]]: The class and subclass labels, or None if the match is not confident enough.
+
+    Example:
+        >>> classify("Tell me about Honey bunches cereal?", embeddings_instance)
+        ['query', 'product_query']
+    """
+    try:
+        labels, exemplar_matrix = _load_exemplars(embeddings)
+        scores = exemplar_matrix @ _normalize(np.asarray(embeddings.embed_query(query), dtype=np.float32))
+    except Exception as e:
+        logging.error(f'CLASSIFY: {e}')
+        return None
+
+    best = int(scores.argmax())
+    logging.info(f'local-classification: {labels[best]} ({scores[best]:.3f})')
+    if scores[best] < threshold:
+        return None
+    return labels[best].split('-')
@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+import functools
+from typing import Optional
+from pymongo.collection import Collection
+
+# Number of turns kept per session and how long an idle session's history is kept (seconds)
+MAX_TURNS = 20
+TTL = 3600
+
+
+@functools.lru_cache(maxsize=1)
+def get_redis():
+    """
+    Returns the Redis client used for chat history, or None if REDIS_URL is not set.
+
+    Example:
+        >>> client = get_redis()
+    """
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        return None
+    import redis
+    return redis.Redis.from_url(redis_url, decode_responses=True)
+
+def _key(session_id: str) -> str:
+    return f'chat:{session_id}'
+
+def get_history(session_id: str, n: int = 3, chatlog_collection: Optional[Collection] = None) -> list[dict]:
+    """
+    Returns the last n query turns of a session, oldest first, from Redis.
+    On a cache miss (cold or expired session) the last MAX_TURNS turns are loaded from the MongoDB chat logs
+    and put back into Redis, so that later calls asking for more turns still see the whole recent conversation.
+
+    Parameters:
+        session_id (str): The session ID associated with the conversation.
+        n (int): Number of most recent turns to return. Default is 3.
+        chatlog_collection (Collection): Optional. The MongoDB collection containing chat logs, used on a cache miss.
+
+    Returns:
+        list[dict]: The turns as {'query': ..., 'text': ...} dictionaries.
+
+    Example:
+        >>> get_history('session_123', n=3, chatlog_collection=chatlog_collection_instance)
+        [{'query': 'Tell me about Honey bunches cereal?', 'text': 'Honey Bunches of Oats cereal is ...'}]
+    """
+    client = get_redis()
+    if client is not None:
+        try:
+            turns = client.lrange(_key(session_id), 0, n-1)
+            if turns:
+                return [json.loads(turn) for turn in reversed(turns)]
+        except Exception as e:
+            logging.error(f'GET_HISTORY: {e}')
+
+    if chatlog_collection is None:
+        return []
+    turns = list(reversed(list(chatlog_collection.find({"session_id": session_id, "class": "query"}, {"query": 1, "text": 1, "_id": 0}).sort([("timestamp", -1)]).limit(MAX_TURNS))))
+    _fill(session_id, turns)
+    return turns[-n:] if n > 0 else []
+
+def _fill(session_id: str, turns: list[dict]) -> None:
+    client = get_redis()
+    if client is None or not turns:
+        return
+    try:
+        pipe = client.pipeline()
+        pipe.delete(_key(session_id))
+        pipe.lpush(_key(session_id), *[json.dumps({'query': turn['query'], 'text': turn['text']}) for turn in turns])
+        pipe.expire(_key(session_id), TTL)
+        pipe.execute()
+    except Exception as e:
+        logging.error(f'FILL_HISTORY: {e}')
+
+def append(session_id: str, query: str, text: str) -> None:
+    """
+    Adds a turn to a session's history, keeping only the last MAX_TURNS turns for TTL seconds.
+
+    Parameters:
+        session_id (str): The session ID associated with the conversation.
+        query (str): The user query.
+        text (str): The response to the query.
+
+    Example:
+        >>> append('session_123', 'Tell me about Honey bunches cereal?', 'Honey Bunches of Oats cereal is ...')
+    """
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline()
+        pipe.lpush(_key(session_id), json.dumps({'query': query, 'text': text}))
+        pipe.ltrim(_key(session_id), 0, MAX_TURNS-1)
+        pipe.expire(_key(session_id), TTL)
+        pipe.execute()
+    except Exception as e:
+        logging.error(f'APPEND_HISTORY: {e}')
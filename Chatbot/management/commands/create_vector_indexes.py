@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from Chatbot.views import create_vector_index
+
+# (database, collection, index) of every Atlas vector search index the chatbot queries
+VECTOR_INDEXES = [
+    ('knowledge', 'products', 'searchindex'),
+    ('chat', 'semantic_cache', 'cacheindex'),
+]
+
+
+class Command(BaseCommand):
+    help = "Creates the Atlas vector search indexes used by the product search and the semantic cache."
+
+    def handle(self, *args, **options):
+        for database_name, collection_name, index_name in VECTOR_INDEXES:
+            try:
+                create_vector_index(database_name, collection_name, index_name)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'{database_name}.{collection_name} {index_name}: {e}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{database_name}.{collection_name} {index_name}: created'))
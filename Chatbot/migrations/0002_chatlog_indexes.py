@@ -0,0 +1,31 @@
+# Generated by Django 4.2.10 on 2026-10-15 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chatbot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatlog',
+            name='session_id',
+            field=models.CharField(max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='chatlog',
+            name='username',
+            field=models.CharField(max_length=150),
+        ),
+        migrations.AddIndex(
+            model_name='chatlog',
+            index=models.Index(fields=['session_id', '-timestamp'], name='chatlog_session_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatlog',
+            index=models.Index(fields=['username', '-timestamp'], name='chatlog_username_ts_idx'),
+        ),
+    ]
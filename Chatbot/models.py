@@ -4,9 +4,14 @@ from django.db import models
 
 class chatlog(models.Model):
     chatlognr = models.AutoField(primary_key=True)
-    session_id = models.TextField()
-    username = models.TextField()
+    session_id = models.CharField(max_length=40)
+    username = models.CharField(max_length=150)
     timestamp = models.DateTimeField(auto_now_add=True)
     prompt = models.TextField()
     response = models.TextField()
-    
\ No newline at end of file
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['session_id', '-timestamp'], name='chatlog_session_ts_idx'),
+            models.Index(fields=['username', '-timestamp'], name='chatlog_username_ts_idx'),
+        ]
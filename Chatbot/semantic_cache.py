@@ -0,0 +1,90 @@
+import os
+import logging
+from typing import Optional
+from datetime import datetime, timezone
+from pymongo.collection import Collection
+from langchain_openai.embeddings import OpenAIEmbeddings
+
+
+def get(prompt: str, collection: Collection, embeddings: OpenAIEmbeddings,
+        index_name: str = 'cacheindex', threshold: float = 0.95,
+        num_candidates: int = int(os.getenv('CACHE_NUM_CANDIDATES', 50))) -> Optional[str]:
+    """
+    Looks up a previously cached response for a semantically equivalent prompt.
+
+    Atlas reports the cosine similarity of a vector search match as vectorSearchScore = (1 + cosine) / 2,
+    so the threshold is converted to that scale before it is compared.
+
+    Parameters:
+        prompt (str): The user prompt to look up.
+        collection (Collection): The MongoDB collection holding cached (embedding, response) pairs.
+        embeddings (OpenAIEmbeddings): The embeddings model used to embed the prompt.
+        index_name (str): The name of the Atlas vector search index on the 'embedding' field. Default is 'cacheindex',
+                          created by `python manage.py create_vector_indexes`.
+        threshold (float): Minimum cosine similarity for a cached response to be returned. Default is 0.95,
+                           i.e. a vectorSearchScore of at least 0.975.
+        num_candidates (int): Number of nearest neighbours considered by the vector search. Default is os.getenv('CACHE_NUM_CANDIDATES') or 50.
+
+    Returns:
+        Optional[str]: The cached response on a hit, None otherwise.
+
+    Example:
+        >>> get("What is the price of Honey bunches cereal?", cache_collection, embeddings)
+        'Honey Bunches of Oats is priced at ...'
+    """
+    try:
+        pipeline = [
+            {'$vectorSearch': {'index': index_name,
+                               'path': 'embedding',
+                               'queryVector': embeddings.embed_query(prompt),
+                               'numCandidates': num_candidates,
+                               'limit': 1}},
+            {'$project': {'_id': 0, 'response': 1, 'score': {'$meta': 'vectorSearchScore'}}},
+        ]
+        hits = list(collection.aggregate(pipeline))
+    except Exception as e:
+        logging.error(f'SEMANTIC_CACHE_GET: {e}')
+        return None
+
+    if hits and hits[0]['score'] >= (1 + threshold) / 2:
+        return hits[0]['response']
+    return None
+
+def put(prompt: str, response: str, collection: Collection, embeddings: OpenAIEmbeddings) -> None:
+    """
+    Stores a prompt and its response in the semantic cache.
+
+    Parameters:
+        prompt (str): The user prompt that was answered.
+        response (str): The response generated for the prompt.
+        collection (Collection): The MongoDB collection holding cached (embedding, response) pairs.
+        embeddings (OpenAIEmbeddings): The embeddings model used to embed the prompt.
+
+    Example:
+        >>> put("What is the price of Honey bunches cereal?", "Honey Bunches of Oats is priced at ...",
+                cache_collection, embeddings)
+    """
+    try:
+        collection.insert_one({'embedding': embeddings.embed_query(prompt),
+                               'prompt': prompt,
+                               'response': response,
+                               # TTL indexes expire documents by UTC time
+                               'ts': datetime.now(timezone.utc)})
+    except Exception as e:
+        logging.error(f'SEMANTIC_CACHE_PUT: {e}')
+
+def ensure_ttl_index(collection: Collection, ttl: int = int(os.getenv('CACHE_TTL', 86400))) -> None:
+    """
+    Creates a TTL index on the 'ts' field so that cached responses expire after ttl seconds.
+
+    Parameters:
+        collection (Collection): The MongoDB collection holding cached (embedding, response) pairs.
+        ttl (int): Number of seconds a cached response is kept. Default is os.getenv('CACHE_TTL') or 86400.
+
+    Example:
+        >>> ensure_ttl_index(cache_collection)
+    """
+    try:
+        collection.create_index('ts', expireAfterSeconds=ttl)
+    except Exception as e:
+        logging.error(f'SEMANTIC_CACHE_TTL_INDEX: {e}')
@@ -1,3 +1,184 @@
-from django.test import TestCase
+from unittest import mock
+from django.test import SimpleTestCase
+from langchain_core.embeddings import Embeddings
+from . import classifier, history, semantic_cache
+from .batcher import ChatlogBatcher
 
-# Create your tests here.
+
+class ChatlogBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.collection = mock.Mock()
+        self.batcher = ChatlogBatcher(lambda: self.collection, max_batch=3, max_wait=0.05)
+
+    def test_drain_stops_at_max_batch(self):
+        for i in range(5):
+            self.batcher._queue.put((f'row-{i}', None))
+        self.assertEqual(self.batcher._drain(), [('row-0', None), ('row-1', None), ('row-2', None)])
+        self.assertEqual(self.batcher._queue.qsize(), 2)
+
+    def test_drain_returns_partial_batch_after_max_wait(self):
+        self.batcher._queue.put(('row-0', None))
+        self.assertEqual(self.batcher._drain(), [('row-0', None)])
+
+    @mock.patch('Chatbot.batcher.close_old_connections')
+    @mock.patch('Chatbot.batcher.chatlog')
+    def test_flush_writes_everything_queued(self, chatlog, close_old_connections):
+        self.batcher._queue.put(('row-0', {'text': 'a'}))
+        self.batcher._queue.put(('row-1', None))
+        self.batcher._queue.put(('row-2', {'text': 'b'}))
+        self.batcher._queue.put(('row-3', None))
+        self.batcher.flush()
+
+        chatlog.objects.bulk_create.assert_called_once_with(['row-0', 'row-1', 'row-2', 'row-3'])
+        self.collection.insert_many.assert_called_once_with([{'text': 'a'}, {'text': 'b'}], ordered=False)
+        self.assertEqual(close_old_connections.call_count, 2)
+        self.assertTrue(self.batcher._queue.empty())
+
+    @mock.patch('Chatbot.batcher.close_old_connections')
+    @mock.patch('Chatbot.batcher.chatlog')
+    def test_flush_with_empty_queue_writes_nothing(self, chatlog, close_old_connections):
+        self.batcher.flush()
+
+        chatlog.objects.bulk_create.assert_not_called()
+        self.collection.insert_many.assert_not_called()
+        close_old_connections.assert_not_called()
+
+
+class ExemplarEmbeddings(Embeddings):
+    """Embeds each exemplar as its own one-hot vector and any other text on a separate axis."""
+    def __init__(self):
+        self.texts = [text for texts in classifier.EXEMPLARS.values() for text in texts]
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = [0.0] * (len(self.texts) + 1)
+        vector[self.texts.index(text) if text in self.texts else -1] = 1.0
+        return vector
+
+
+class ClassifierTests(SimpleTestCase):
+    def setUp(self):
+        classifier._labels, classifier._exemplar_matrix = None, None
+        self.embeddings = ExemplarEmbeddings()
+
+    def tearDown(self):
+        classifier._labels, classifier._exemplar_matrix = None, None
+
+    def test_classify_returns_class_and_subclass_of_nearest_exemplar(self):
+        self.assertEqual(classifier.classify("Cancel my order", self.embeddings), ['order', 'cancel_order'])
+        self.assertEqual(classifier.classify("What is the capital of France?", self.embeddings),
+                         ['tangential', 'unrelated'])
+
+    def test_classify_returns_none_below_threshold(self):
+        self.assertIsNone(classifier.classify("Something no exemplar looks like", self.embeddings))
+
+    def test_exemplars_are_embedded_once(self):
+        classifier.classify("Hi", self.embeddings)
+        classifier.classify("Track my order", self.embeddings)
+        self.assertEqual(self.embeddings.calls, 1)
+
+
+class FakeRedis:
+    """The subset of the Redis list commands used by the chat history, kept in memory."""
+    def __init__(self):
+        self.lists, self.ttls = {}, {}
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end+1]
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists.get(key, [])[start:end+1]
+
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+
+    def delete(self, key):
+        self.lists.pop(key, None)
+
+
+class HistoryTests(SimpleTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(history, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def turns(self, count):
+        return [{'query': f'query-{i}', 'text': f'text-{i}'} for i in range(count)]
+
+    def test_get_history_returns_last_turns_oldest_first(self):
+        for turn in self.turns(5):
+            history.append('abc', **turn)
+
+        self.assertEqual(history.get_history('abc', n=3), self.turns(5)[2:])
+        self.assertEqual(self.redis.ttls['chat:abc'], history.TTL)
+
+    def test_append_keeps_only_max_turns(self):
+        for turn in self.turns(history.MAX_TURNS + 5):
+            history.append('abc', **turn)
+
+        self.assertEqual(len(self.redis.lists['chat:abc']), history.MAX_TURNS)
+        self.assertEqual(history.get_history('abc', n=history.MAX_TURNS), self.turns(history.MAX_TURNS + 5)[5:])
+
+    def test_get_history_falls_back_to_chat_logs_and_refills_all_turns(self):
+        chatlog_collection = mock.Mock()
+        chatlog_collection.find.return_value.sort.return_value.limit.return_value = list(reversed(self.turns(5)))
+
+        self.assertEqual(history.get_history('abc', n=1, chatlog_collection=chatlog_collection), self.turns(5)[4:])
+        chatlog_collection.find.return_value.sort.return_value.limit.assert_called_once_with(history.MAX_TURNS)
+        # Later calls asking for more turns are served from Redis with the whole conversation
+        self.assertEqual(history.get_history('abc', n=3), self.turns(5)[2:])
+        chatlog_collection.find.assert_called_once()
+
+    def test_get_history_without_redis_or_chat_logs_is_empty(self):
+        self.assertEqual(history.get_history('abc', n=3), [])
+
+
+class SemanticCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.collection = mock.Mock()
+        self.embeddings = mock.Mock()
+        self.embeddings.embed_query.return_value = [0.1, 0.2, 0.3]
+
+    def test_get_returns_response_above_threshold(self):
+        self.collection.aggregate.return_value = [{'response': 'cached', 'score': 0.98}]
+
+        self.assertEqual(semantic_cache.get('Hi', self.collection, self.embeddings, threshold=0.95), 'cached')
+        vector_search = self.collection.aggregate.call_args[0][0][0]['$vectorSearch']
+        self.assertEqual(vector_search['queryVector'], [0.1, 0.2, 0.3])
+        self.assertEqual(vector_search['limit'], 1)
+
+    def test_get_compares_threshold_as_cosine_similarity(self):
+        # A vectorSearchScore of 0.96 is a cosine similarity of 0.92
+        self.collection.aggregate.return_value = [{'response': 'cached', 'score': 0.96}]
+
+        self.assertIsNone(semantic_cache.get('Hi', self.collection, self.embeddings, threshold=0.95))
+
+    def test_get_returns_none_on_miss_or_error(self):
+        self.collection.aggregate.return_value = []
+        self.assertIsNone(semantic_cache.get('Hi', self.collection, self.embeddings))
+
+        self.collection.aggregate.side_effect = Exception('index not found')
+        self.assertIsNone(semantic_cache.get('Hi', self.collection, self.embeddings))
+
+    def test_put_stores_embedding_response_and_utc_timestamp(self):
+        semantic_cache.put('Hi', 'Hello!', self.collection, self.embeddings)
+
+        document = self.collection.insert_one.call_args[0][0]
+        self.assertEqual({key: document[key] for key in ('embedding', 'prompt', 'response')},
+                         {'embedding': [0.1, 0.2, 0.3], 'prompt': 'Hi', 'response': 'Hello!'})
+        self.assertIsNotNone(document['ts'].tzinfo)
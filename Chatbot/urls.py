@@ -7,5 +7,5 @@ urlpatterns = [
     path('login', views.login_user, name='login'),
     path('signup', views.signup_user, name='signup'),
     path('signed', views.signed, name='signed'),
-    path('chatbot', views.chatbot, name='chatbot'),
+    path('chatbot', views.ChatbotView.as_view(), name='chatbot'),
 ]
\ No newline at end of file
@@ -1,18 +1,62 @@
 import os
 import re
+import queue
 import logging
+import contextvars
 from time import time
-import streamlit as st
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote_plus
 from tiktoken import get_encoding
 from langchain.chains import LLMChain
 from langchain_openai import ChatOpenAI
 from simple_salesforce import Salesforce
 from pymongo.collection import Collection
 from langchain_core.prompts import PromptTemplate
+from langchain_core.embeddings import Embeddings
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_community.callbacks import get_openai_callback
 from langchain_community.vectorstores.mongodb_atlas import MongoDBAtlasVectorSearch
+from . import classifier, history
 
+# Shared pool for running independent LLM sub-calls concurrently
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('LLM_WORKERS', 8)))
+
+def run_in_background(fn, *args, **kwargs) -> Future:
+    """
+    Runs a function on the shared thread pool, carrying over the caller's context variables
+    so that callbacks such as get_openai_callback() still account for the calls made by it.
+
+    Parameters:
+        fn: The function to run.
+        *args, **kwargs: Arguments passed to the function.
+
+    Returns:
+        Future: A future holding the result of the function.
+
+    Example:
+        >>> future = run_in_background(classify_query, llm=llm_instance, query="Hi", classification_template=template)
+        >>> future.result()
+        ['query', 'greetings']
+    """
+    return _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+class TokenQueueCallbackHandler(BaseCallbackHandler):
+    """
+    Puts every token generated by a streaming LLM on a queue, so that it can be sent to the client as it arrives.
+
+    Parameters:
+        tokens (queue.Queue): The queue the tokens are put on.
+
+    Example:
+        >>> tokens = queue.Queue()
+        >>> llm_chain.invoke(input=chain_input, config={'callbacks': [TokenQueueCallbackHandler(tokens)]})
+    """
+    def __init__(self, tokens: queue.Queue):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.tokens.put(token)
 
 def calculate_tokens(string: str) -> int:
     """
@@ -88,36 +132,108 @@ def hallucination_checker(llm: ChatOpenAI, sources: str, chat_history: str, hall
     """
     return llm.invoke(hallucination_template.format(sources=sources,chat_history=chat_history)).content
 
-def get_relevant_docs(vector_store: MongoDBAtlasVectorSearch, query: str, about_org: str) -> dict:
+def get_search_query(llm: ChatOpenAI, chatlog_collection: Collection, query: str,
+                     query_rewriter_template: PromptTemplate, session_id: str) -> tuple[str, str]:
+    """
+    Fetches the recent conversation for a session (from the Redis history, falling back to the chat logs)
+    and rewrites the query with it for better search retrieval.
+
+    Parameters:
+        llm (ChatOpenAI): The ChatOpenAI language model instance to use for rewriting.
+        chatlog_collection (Collection): The MongoDB collection containing chat logs.
+        query (str): The input query to be rewritten.
+        query_rewriter_template (PromptTemplate): The prompt template for query rewriter.
+        session_id (str): The session ID associated with the query.
+
+    Returns:
+        tuple[str, str]: The conversation memory and the rewritten query.
+
+    Example:
+        >>> get_search_query(llm_instance, chatlog_collection_instance, "what is the price?", template, "session_123")
+        ('Human: Tell me about Honey bunches cereal?\nAI: ...', 'What is the price of Honey bunches cereal?')
+    """
+    memory_list = history.get_history(session_id, n=3, chatlog_collection=chatlog_collection)
+    memory = ''.join(f"Human: {item['query']}\nAI: {item['text']}\n\n" for item in memory_list).rstrip('\n')
+    logging.info(f'memory: {memory}')
+
+    rewritten_query = query_rewiriter(llm=llm,memory=memory+'Human: '+query,query_rewriter_template=query_rewriter_template)
+    logging.info(f'originial-query: {query}')
+    logging.info(f'rewritten-query: {rewritten_query}')
+    return memory, rewritten_query
+
+def flag_hallucination(llm: ChatOpenAI, sources: str, chat_history: str, hallucination_template: PromptTemplate,
+                       chain_resp: dict, flagged_response_collection: Collection) -> str:
+    """
+    Runs the hallucination checker and stores the response in the flagged collection if it is flagged.
+    Meant to be run in the background so that the check does not delay the response.
+
+    Parameters:
+        llm (ChatOpenAI): The ChatOpenAI language model instance to use for hallucination checking.
+        sources (str): The sources used for generating the response.
+        chat_history (str): The chat history in which the response was produced.
+        hallucination_template (PromptTemplate): The prompt template for hallucination checker.
+        chain_resp (dict): The response to be stored if it is flagged.
+        flagged_response_collection (Collection): The MongoDB collection flagged responses are written to.
+
+    Returns:
+        str: The result of hallucination checking. ("0"-No Hallucination or "1"-Possible Hallucination)
+
+    Example:
+        >>> run_in_background(flag_hallucination, llm_instance, sources, memory, template, chain_resp, flagged_collection)
+    """
+    try:
+        flag = hallucination_checker(llm=llm, sources=sources, chat_history=chat_history,
+                                     hallucination_template=hallucination_template)
+        if flag.strip() == '1' and flagged_response_collection is not None:
+            flagged_response_collection.insert_one({**chain_resp, 'hallucination_flag': flag})
+        return flag
+    except Exception as e:
+        logging.error(f'FLAG_HALLUCINATION: {e}')
+        return ''
+
+def get_relevant_docs(vector_store: MongoDBAtlasVectorSearch, query: str, about_org: str,
+                      max_context_tokens: int = 3500) -> dict:
     """
     Retrieves relevant documents from a MongoDBAtlasVectorSearch based on a query and context constraints.
 
     Parameters:
         vector_store (MongoDBAtlasVectorSearch): The MongoDBAtlasVectorSearch instance to search for relevant documents.
         query (str): The query used to search for relevant documents.
-        about_org (str): Details about the organization.
+        about_org (str): Details about the organization, added as the first source. Skipped if empty.
+        max_context_tokens (int): Token budget of the retrieved context, including about_org. Default is 3500.
 
     Returns:
-        dict: A dictionary containing the retrieved context and relevant document IDs.
+        dict: A dictionary containing the retrieved context, relevant document IDs and the highest similarity score.
 
     Example:
         >>> get_relevant_docs(vector_store_instance, "breakfast cereals")
         {'context': '\nSource 1 : abc\nSource 2: def\nSource 3: ghi',
-         'context_id': ['product-abc', 'product-def', 'product-ghi']}
-    """
-    context=f'\nSource 1: \n\n{about_org}\n\n'
-    source_num,context_id = 2,[]
-    docs = vector_store.similarity_search(query,k=3)
+         'context_id': ['product-abc', 'product-def', 'product-ghi'],
+         'top_score': 0.87}
+    """
+    context, source_num, context_id, top_score = '', 1, [], 0.0
+    if about_org:
+        context += f'\nSource 1: \n\n{about_org}\n\n'
+        source_num += 1
+    # Running token count of the context, so each source is tokenized once rather than the whole context per source
+    context_tokens = calculate_tokens(context)
+    search_start = time()
+    docs = vector_store.similarity_search_with_score(query,k=3)
+    logging.info(f'vector-search-latency-ms: {round((time()-search_start)*1000)}')
     try:
-        for i in docs:
-            if calculate_tokens(context+i.page_content) < 3500:
-                context += '\nSource {}: \n\n{}\n'.format(source_num,i.page_content)
+        for i, score in docs:
+            top_score = max(top_score, score)
+            source = '\nSource {}: \n\n{}\n'.format(source_num,i.page_content)
+            source_tokens = calculate_tokens(source)
+            if context_tokens + source_tokens < max_context_tokens:
+                context += source
+                context_tokens += source_tokens
                 source_num+=1
                 context_id.append(i.metadata['id'])
     except Exception as e:
         logging.error(f"get_relevant_docs(): Couldn't retrieve content: {e}")
 
-    return {'context':context,'context_id':context_id}
+    return {'context':context,'context_id':context_id,'top_score':top_score}
 
 def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
                         chatlog_collection: Collection, 
@@ -125,7 +241,10 @@ def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
                         query_rewriter_template: PromptTemplate, 
                         hallucination_template: PromptTemplate,
                         about_org: str, model_name: str, query: str, 
-                        hallucination_check: bool, sub_class: str, session_id: str, **kwargs) -> dict:
+                        hallucination_check: bool, sub_class: str, session_id: str,
+                        search_query: Future = None, flagged_response_collection: Collection = None,
+                        system_about_org: str = '', max_context_tokens: int = 3500, hallucination_skip_score: float = float(os.getenv('HALLUC_SKIP_SCORE', 0.82)),
+                        callbacks: list = None, **kwargs) -> dict:
     """
     Handles classification queries using a pipeline of language models and relevant document retrieval.
 
@@ -142,6 +261,15 @@ def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
         hallucination_check (bool): A flag indicating whether hallucination checking should be performed.
         sub_class (str): The subclass of the query.
         session_id (str): The session ID associated with the query.
+        search_query (Future): Optional. A future holding the (memory, rewritten query) pair, if the rewrite was
+                               already started alongside the classification.
+        flagged_response_collection (Collection): Optional. The MongoDB collection flagged responses are written to.
+        system_about_org (str): Optional. Details about the organization that are part of the system prompt instead of
+                                the retrieved context. They are given to the hallucination checker as a source.
+        max_context_tokens (int): Token budget of the retrieved context. Default is 3500.
+        hallucination_skip_score (float): Retrieval score at or above which the hallucination check is skipped.
+                                          Default is os.getenv('HALLUC_SKIP_SCORE') or 0.82.
+        callbacks (list): Optional. Callback handlers for the answer generation, e.g. to stream its tokens.
         **kwargs: Additional keyword arguments.
 
     Returns:
@@ -157,15 +285,15 @@ def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
         except:
             pass
 
-        memory_list = list(reversed(list(chatlog_collection.find({"session_id": session_id, "class": "query"}, {"query": 1, "text": 1, "_id": 0}).sort([("timestamp", -1)]).limit(3))))
-        memory = ''.join(f"Human: {item['query']}\nAI: {item['text']}\n\n" for item in memory_list).rstrip('\n')
-        logging.info(f'memory: {memory}')
-
-        rewritten_query = query_rewiriter(llm=llm,memory=memory+'Human: '+query,query_rewriter_template=query_rewriter_template)
-        logging.info(f'originial-query: {query}')
-        logging.info(f'rewritten-query: {rewritten_query}')
+        if search_query is not None:
+            memory, rewritten_query = search_query.result()
+        else:
+            memory, rewritten_query = get_search_query(llm=llm, chatlog_collection=chatlog_collection, query=query,
+                                                       query_rewriter_template=query_rewriter_template,
+                                                       session_id=session_id)
 
-        relevant_docs = get_relevant_docs(vector_store=vector_store,query=rewritten_query,about_org=about_org)
+        relevant_docs = get_relevant_docs(vector_store=vector_store,query=rewritten_query,about_org=about_org,
+                                          max_context_tokens=max_context_tokens)
         logging.info(f'relevant-docs: {relevant_docs["context_id"]}')
 
         try:
@@ -178,13 +306,20 @@ def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
         relevant_docs = {}
         relevant_docs['context'] = ''
         relevant_docs['context_id'] = []
+        relevant_docs['top_score'] = 0.0
 
+    chain_input = {'context':relevant_docs['context'],'chat_history':memory,'query':query}
     try:
-        chain_resp = llm_chain.invoke(input={'context':relevant_docs['context'],'chat_history':memory,'query':query})
+        chain_resp = llm_chain.invoke(input=chain_input, config={'callbacks':callbacks})
+        # get_openai_callback() does not count the tokens of streamed calls, so they are estimated from the text
+        if getattr(llm_chain.llm, 'streaming', False):
+            chain_resp['streamed_prompt_tokens'] = calculate_tokens(llm_chain.prompt.format(**chain_input))
+            chain_resp['streamed_completion_tokens'] = calculate_tokens(chain_resp['text'])
     except Exception as e:
         chain_resp = {}
         chain_resp['text'] = str(e)
         chain_resp['query'] = query
+        chain_resp['error'] = True
 
     try:
         kwargs['status'].update(label=':green[**Publishing response ..**]',state='running',expanded=False)
@@ -195,10 +330,16 @@ def class_query_handler(llm_chain: LLMChain, llm: ChatOpenAI,
     chain_resp['model_name'] = model_name
     chain_resp['search_query'] = rewritten_query
 
-    if hallucination_check == True: 
-        chain_resp['hallucination_flag'] = hallucination_checker(sources=relevant_docs['context'],
-                                                                 chat_history=memory,llm=llm,
-                                                                 hallucination_template=hallucination_template)
+    # Greetings have nothing to check against and closely matching sources mean the answer is well grounded
+    if hallucination_check == True and (sub_class == 'greetings' or relevant_docs['top_score'] >= hallucination_skip_score):
+        chain_resp['hallucination_flag'] = 'Skipped'
+    elif hallucination_check == True: 
+        # The check only affects what is logged, so it runs in the background instead of delaying the response
+        chain_resp['hallucination_flag'] = 'Invoked'
+        sources = f'\n{system_about_org}\n{relevant_docs["context"]}' if system_about_org else relevant_docs['context']
+        run_in_background(flag_hallucination, llm=llm, sources=sources, chat_history=memory,
+                          hallucination_template=hallucination_template, chain_resp=dict(chain_resp),
+                          flagged_response_collection=flagged_response_collection)
     else:
         chain_resp['hallucination_flag'] = 'Not Invoked'
     
@@ -295,11 +436,6 @@ def subclass_update_complaint_handler(salesforce_client: Salesforce, case_number
     update_case = {}
     resp = {}
     if case_number != '' and case_number!= None:
-        try:
-            case_id = salesforce_client.query("SELECT Id FROM case WHERE CaseNumber = '{}'".format(case_number))['records'][0]['Id']
-        except Exception as e:
-            logging.error(f'SUBCLASS_UPDATE_COMPLAINT_HANDLER 1: {e}')
-            resp['message'] = 'Unable to update your case. Please contact our Customer Support team'
         if customer_name != '': 
             update_case['SuppliedName'] = customer_name
         if phone != '':
@@ -311,11 +447,24 @@ def subclass_update_complaint_handler(salesforce_client: Salesforce, case_number
         if description != '':
             update_case['Description'] = description
         try:
-            status_code = salesforce_client.Case.update(case_id,update_case)
-            if status_code == 204:
+            # The case lookup and the update are sent as one Composite API request, the update referencing the looked up Id
+            api_path = f'/services/data/v{salesforce_client.sf_version}'
+            case_query = quote_plus("SELECT Id FROM case WHERE CaseNumber = '{}'".format(case_number))
+            composite_request = {'allOrNone': True,
+                                 'compositeRequest': [
+                                     {'method': 'GET', 'referenceId': 'case',
+                                      'url': f'{api_path}/query/?q={case_query}'},
+                                     {'method': 'PATCH', 'referenceId': 'update',
+                                      'url': f'{api_path}/sobjects/Case/@{{case.records[0].Id}}', 'body': update_case},
+                                 ]}
+            composite_resp = salesforce_client.restful('composite', method='POST', json=composite_request)
+            if composite_resp['compositeResponse'][-1]['httpStatusCode'] == 204:
                 resp['message'] = 'Your case has been updated successfully!'
+            else:
+                logging.error(f'SUBCLASS_UPDATE_COMPLAINT_HANDLER: {composite_resp}')
+                resp['message'] = 'Unable to update your case. Please contact our Customer Support team'
         except Exception as e:
-            logging.error(f'SUBCLASS_UPDATE_COMPLAINT_HANDLER 2: {e}')
+            logging.error(f'SUBCLASS_UPDATE_COMPLAINT_HANDLER: {e}')
             resp['message'] = 'Unable to update your case. Please contact our Customer Support team'
     else:
         resp['message'] = 'Unable to update your case due to Invalid Case Number. Please contact our Customer Support team'
@@ -344,7 +493,7 @@ def subclass_view_complaint_handler(salesforce_client: Salesforce, phone: str =
     resp = {}
     message = 'Here are the Case details: \n\n\n\n---------------'
     try:
-        resp = salesforce_client.query(query)
+        resp = salesforce_client.query_all(query)
     except Exception as e:
         logging.error(f'SUBCLASS_VIEW_COMPLAINT_HANDLER: {e}')
         resp['totalSize'] = -1
@@ -410,6 +559,8 @@ def chat_response(query: str, llm_chain: LLMChain, llm: ChatOpenAI,
                   about_org: str, org_name: str,
                   hallucination_check:bool = False, log: bool = True, status = None, 
                   session_id: str = 'test-session', username: str = 'test-user',
+                  flagged_response_collection: Collection = None, system_about_org: str = '',
+                  max_context_tokens: int = 3500, embeddings: Embeddings = None, callbacks: list = None,
                   model_name: str = os.getenv('GPT_3_MODEL')) -> dict:
     """
     Generates a response to a user query based on classification and processing through a pipeline of language models.
@@ -429,6 +580,13 @@ def chat_response(query: str, llm_chain: LLMChain, llm: ChatOpenAI,
         status: Optional. Status information for tracking progress.
         session_id (str): The session ID associated with the query. Default is 'test-session'.
         username (str): The username associated with the query. Default is 'test-user'.
+        flagged_response_collection (Collection): Optional. The MongoDB collection responses flagged by the hallucination checker are written to.
+        system_about_org (str): Optional. Details about the organization that are part of the system prompt instead of
+                                the retrieved context. They are given to the hallucination checker as a source.
+        max_context_tokens (int): Token budget of the retrieved context. Default is 3500.
+        embeddings (Embeddings): Optional. If given, queries are first classified locally by their nearest labeled exemplar,
+                                 falling back to the LLM classifier when the match is not confident enough.
+        callbacks (list): Optional. Callback handlers for the answer generation, e.g. to stream its tokens.
         model_name (str): The name of the model being used. Default is os.getenv('GPT_3_MODEL').
         **kwargs: Additional keyword arguments.
 
@@ -443,10 +601,19 @@ def chat_response(query: str, llm_chain: LLMChain, llm: ChatOpenAI,
     start = time()
 
     with get_openai_callback() as cb:
-        label_resp = classify_query(llm = llm, query=query, classification_template=classification_template)
+        # The query rewrite does not depend on the classification, so both run concurrently
+        search_query = run_in_background(get_search_query, llm=llm, chatlog_collection=chatlog_collection, query=query,
+                                         query_rewriter_template=query_rewriter_template, session_id=session_id)
+        label_resp = classifier.classify(query=query, embeddings=embeddings) if embeddings is not None else None
+        if label_resp is None:
+            label_resp = classify_query(llm = llm, query=query, classification_template=classification_template)
 
         if len(label_resp) == 1:
             label_resp.append('unknown')
+
+        # Only non-greeting queries use the rewrite; for the rest it is cancelled if it has not started yet
+        if label_resp[0] not in ('query', '1') or label_resp[1] == 'greetings':
+            search_query.cancel()
         
         if label_resp[0] == 'query' or label_resp[0] == '1':
             chain_resp = class_query_handler(llm=llm, llm_chain=llm_chain,
@@ -458,9 +625,15 @@ def chat_response(query: str, llm_chain: LLMChain, llm: ChatOpenAI,
                                              hallucination_check = hallucination_check, 
                                              about_org = about_org,
                                              status=status, sub_class = label_resp[1],
-                                             session_id=session_id)
+                                             session_id=session_id, search_query=search_query,
+                                             flagged_response_collection=flagged_response_collection,
+                                             system_about_org=system_about_org, max_context_tokens=max_context_tokens,
+                                             callbacks=callbacks)
             
             chain_resp.update({'class':label_resp[0],'sub_class':label_resp[1]})
+            # Failed generations hold the error message, which should not become part of the conversation
+            if not chain_resp.get('error'):
+                history.append(session_id, query=query, text=chain_resp['text'])
         
         elif label_resp[0] == 'complaint' or label_resp[0] == '2':
             chain_resp={'query':query,
@@ -486,17 +659,19 @@ def chat_response(query: str, llm_chain: LLMChain, llm: ChatOpenAI,
             chain_resp={'query':query,
                         'class':'tangential',
                         'sub_class':label_resp[1],
-                        'text':class_tangential_handler(sub_class=label_resp[1],org_name=org_name),
+                        'text':class_tangential_handler(sub_class=label_resp[1],company_name=org_name),
                         'context_id':[],
                         'search_query':'',
                         'hallucination_flag':'Not Invoked',
                         }
-            
+
+    prompt_tokens = cb.prompt_tokens + chain_resp.pop('streamed_prompt_tokens', 0)
+    completion_tokens = cb.completion_tokens + chain_resp.pop('streamed_completion_tokens', 0)
     chain_resp.update({'total_time':round(time()-start,2),
-                       'prompt_tokens':round(cb.prompt_tokens,3),
-                       'completion_tokens':round(cb.completion_tokens,3),
-                       'total_tokens': round(cb.total_tokens,3),
-                       'total_cost': round(((cb.prompt_tokens/1000)*0.0005)+((cb.completion_tokens/1000)*0.0015),5),
+                       'prompt_tokens':round(prompt_tokens,3),
+                       'completion_tokens':round(completion_tokens,3),
+                       'total_tokens': round(prompt_tokens+completion_tokens,3),
+                       'total_cost': round(((prompt_tokens/1000)*0.0005)+((completion_tokens/1000)*0.0015),5),
                        'model_name': model_name,
                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                        'session_id': session_id,
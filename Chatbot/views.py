@@ -1,60 +1,114 @@
-import openai
 import os
-import supabase
-import pandas as pd
-import psycopg2
+import time
+import orjson
+import queue
+import hashlib
+import functools
+import threading
+from typing import ClassVar, Optional
+from datetime import datetime
+from cachetools import LRUCache
+from concurrent.futures import ThreadPoolExecutor
 
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
-from django.http.response import HttpResponse
+from django.http.response import StreamingHttpResponse
+from django.views import View
+from django.contrib.auth.mixins import LoginRequiredMixin
 
 from dotenv import load_dotenv
-from langchain_community.llms import OpenAI
-from langchain.sql_database import SQLDatabase
-from langchain_experimental.sql import SQLDatabaseChain
-from langchain_community.agent_toolkits import create_sql_agent
 from langchain_openai import ChatOpenAI
-from langchain.chains import create_sql_query_chain
 from .models import chatlog
 
-from .utils import chat_response, subclass_create_complaint_handler, subclass_update_complaint_handler, subclass_view_complaint_handler
+from .utils import chat_response, calculate_tokens, TokenQueueCallbackHandler, subclass_create_complaint_handler, subclass_update_complaint_handler, subclass_view_complaint_handler
+from . import semantic_cache, history
+from .batcher import ChatlogBatcher
 from simple_salesforce import Salesforce
+from requests.exceptions import RequestException
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from pymongo.collection import Collection
 from pymongo import MongoClient
 import logging
 from langchain_community.vectorstores.mongodb_atlas import MongoDBAtlasVectorSearch
 from langchain_openai.embeddings import OpenAIEmbeddings
+from langchain_core.documents import Document
 from langchain.prompts import PromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
 from langchain.chains import LLMChain
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 
-def salesforce_connect() -> Salesforce:
+class CachedEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAIEmbeddings that keeps the vectors of recently embedded queries in a process-wide LRU cache,
+    so a query that was already embedded (by the semantic cache, classifier or retriever) skips the API call.
+    """
+    _query_cache: ClassVar[LRUCache] = LRUCache(maxsize=int(os.getenv('EMBEDDINGS_CACHE_SIZE', 4096)))
+    _query_cache_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def embed_query(self, text: str) -> list[float]:
+        key = hashlib.sha256(f'{self.model}:{text}'.encode()).hexdigest()
+        with self._query_cache_lock:
+            vector = self._query_cache.get(key)
+        if vector is None:
+            vector = super().embed_query(text)
+            with self._query_cache_lock:
+                self._query_cache[key] = vector
+        return vector
+
+embeddings = CachedEmbeddings(model=os.getenv('EMBEDDINGS_MODEL'))
+# OpenAI accepts at most 2048 inputs per embeddings request
+MAX_OPENAI_EMBEDDING_BATCH_SIZE = 2048
+
+# Only network errors are retried: repeating a rejected login would count towards the account's lockout limit
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.5, max=5),
+       retry=retry_if_exception_type(RequestException), reraise=True)
+def _salesforce_login() -> Salesforce:
+    return Salesforce(username=os.getenv('SF_USERNAME'), 
+                      password=os.getenv('SF_PASSWORD'), 
+                      security_token=os.getenv('SF_SECURITY_TOKEN'))
+
+def salesforce_connect() -> Optional[Salesforce]:
     """
     Initialize a Salesforce client object.
 
     This function attempts to establish a connection to Salesforce using the provided credentials
     fetched from environment variables: SF_USERNAME, SF_PASSWORD, and SF_SECURITY_TOKEN.
+    Logins that fail with a network error are retried up to 3 times with exponential backoff.
 
     Returns:
-        Salesforce client object: An instance of Salesforce client upon successful connection.
+        Optional[Salesforce]: An instance of Salesforce client upon successful connection, None otherwise.
 
-    Raises:
-        Exception: If any error occurs during the connection attempt, it catches the exception
-                   and returns an error message string.
+    Example:
+        >>> sf = salesforce_connect()
     """
     try: 
-        sf = Salesforce(username=os.getenv('SF_USERNAME'), 
-                        password=os.getenv('SF_PASSWORD'), 
-                        security_token=os.getenv('SF_SECURITY_TOKEN'))
-        return sf
+        return _salesforce_login()
     except Exception as e:
-        return f"Error: {e}"
+        logging.error('Salesforce connection failure: {}'.format(e))
+        return None
     
+@functools.lru_cache(maxsize=1)
+def mongodb_client() -> MongoClient:
+    """
+    Returns the MongoDB client shared by all collections, creating it on first call.
+
+    The client connects lazily and keeps a connection pool that is reused across requests and collections.
+
+    Returns:
+        MongoClient: The shared MongoDB client.
+
+    Example:
+        >>> client = mongodb_client()
+    """
+    return MongoClient(os.getenv('ATLAS_CONNECTION_STRING'),
+                       maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', 50)),
+                       minPoolSize=int(os.getenv('MONGO_MIN_POOL_SIZE', 5)),
+                       serverSelectionTimeoutMS=3000)
+
 def mongodb_collection(database_name: str, collection_name: str) -> Collection:
     """
-    Establishes a connection to a MongoDB collection using the provided database name and collection name.
+    Returns a MongoDB collection using the provided database name and collection name.
 
     Parameters:
         database_name (str): The name of the MongoDB database.
@@ -63,25 +117,16 @@ def mongodb_collection(database_name: str, collection_name: str) -> Collection:
     Returns:
         Collection: A MongoDB Collection object representing the specified collection.
 
-    Raises:
-        ConnectionError: If unable to establish a connection to the MongoDB database.
-        
     Example:
         >>> collection = mongodb_collection('my_database', 'my_collection')
     """
-    connection_string = os.getenv('ATLAS_CONNECTION_STRING')
-    try:
-        client = MongoClient(connection_string)
-        client.server_info()
-        chat_collection = client[database_name][collection_name]
-        return chat_collection
-    except Exception as e:
-        logging.error('Database connection failure: {}'.format(e))
-        return False
+    return mongodb_client()[database_name][collection_name]
 
+@functools.lru_cache(maxsize=None)
 def vector_search(database_name: str, collection_name: str, index_name: str) -> MongoDBAtlasVectorSearch:
     """
     Initializes a MongoDB Atlas Vector Search instance for vector-based search operations.
+    Instances are memoized, so each (database, collection, index) combination is built only once.
 
     Parameters:
         database_name (str): The name of the MongoDB database containing the collection.
@@ -95,26 +140,102 @@ def vector_search(database_name: str, collection_name: str, index_name: str) ->
         >>> search_instance = vector_search('my_database', 'my_collection', 'my_index')
     """
     collection = mongodb_collection(database_name=database_name, collection_name=collection_name)
-    embeddings_model_name = os.getenv('EMBEDDINGS_MODEL')
-    vector_search = MongoDBAtlasVectorSearch(collection=collection,embedding=OpenAIEmbeddings(model=embeddings_model_name), index_name=index_name)
+    vector_search = MongoDBAtlasVectorSearch(collection=collection,embedding=embeddings, index_name=index_name)
     return vector_search
 
+def create_vector_index(database_name: str, collection_name: str, index_name: str,
+                        path: str = 'embedding', similarity: str = 'cosine') -> dict:
+    """
+    Creates an Atlas Vector Search index on a collection's embedding field.
 
-system_prompt_template = SystemMessagePromptTemplate.from_template(
-    template=
-    ("You are given the following extracted parts of marketing documents and a question. "
-    "Read the following documents carefully. \n"
+    Atlas 'vectorSearch' indexes are HNSW graphs, so queries perform an approximate nearest neighbour
+    search over numCandidates candidates instead of scanning every document.
+    The indexes the chatbot needs ('searchindex' and the semantic cache's 'cacheindex') are created with
+    `python manage.py create_vector_indexes`, which must be run once per deployment.
 
-    "\n=========\n"
+    Parameters:
+        database_name (str): The name of the MongoDB database containing the collection.
+        collection_name (str): The name of the collection to be indexed.
+        index_name (str): The name of the index, as used by vector_search() and the semantic cache.
+        path (str): The field holding the embeddings. Default is 'embedding'.
+        similarity (str): The similarity function of the index. Default is 'cosine'.
 
-    "\nRelevant Sources: \n"
+    Returns:
+        dict: The server response to the createSearchIndexes command.
 
-    "{context}"
+    Example:
+        >>> create_vector_index('knowledge', 'products', 'searchindex')
+        >>> create_vector_index('chat', 'semantic_cache', 'cacheindex')
+    """
+    definition = {'fields': [{'type': 'vector', 'path': path, 'similarity': similarity,
+                              'numDimensions': int(os.getenv('EMBEDDINGS_DIMENSIONS', 1536))}]}
+    return mongodb_client()[database_name].command('createSearchIndexes', collection_name,
+                                                    indexes=[{'name': index_name, 'type': 'vectorSearch',
+                                                              'definition': definition}])
+
+def embed_and_upsert(documents: list[Document], vector_store: MongoDBAtlasVectorSearch,
+                     batch_size: int = MAX_OPENAI_EMBEDDING_BATCH_SIZE) -> list:
+    """
+    Embeds and inserts documents into a MongoDB Atlas Vector Search collection in batches.
 
-    "\n=========\n"
+    Each batch of up to batch_size documents is embedded with a single embed_documents() call and written
+    with a single insert_many(), instead of one embeddings request and one insert per document.
+
+    Parameters:
+        documents (list[Document]): The documents to be indexed.
+        vector_store (MongoDBAtlasVectorSearch): The vector store the documents are inserted into.
+        batch_size (int): Number of documents embedded and inserted together. Capped at MAX_OPENAI_EMBEDDING_BATCH_SIZE.
+
+    Returns:
+        list: The ids of the inserted documents.
+
+    Example:
+        >>> embed_and_upsert([Document(page_content='Honey Bunches of Oats ...', metadata={'id': 'product-abc'})],
+                             vector_search('knowledge', 'products', 'searchindex'))
+    """
+    return vector_store.add_texts(texts=[doc.page_content for doc in documents],
+                                  metadatas=[doc.metadata for doc in documents],
+                                  batch_size=min(batch_size, MAX_OPENAI_EMBEDDING_BATCH_SIZE))
+
+def setup_llm_caching() -> None:
+    """
+    Installs a process-wide LangChain cache so identical LLM prompts are answered without calling OpenAI.
+
+    Both caches are exact-match on the full prompt: a RedisCache when the LLM_CACHE_REDIS_URL environment
+    variable is set (shared across worker processes), otherwise a SQLiteCache stored at LLM_CACHE_PATH
+    (default '.llm_cache.sqlite'). A semantic cache is not used here, as the templated prompts share most of
+    their text and would match across unrelated queries.
+
+    Example:
+        >>> setup_llm_caching()
+    """
+    redis_url = os.getenv('LLM_CACHE_REDIS_URL')
+    try:
+        if redis_url:
+            import redis
+            from langchain_community.cache import RedisCache
+            set_llm_cache(RedisCache(redis_=redis.Redis.from_url(redis_url)))
+        else:
+            set_llm_cache(SQLiteCache(database_path=os.getenv('LLM_CACHE_PATH', '.llm_cache.sqlite')))
+    except Exception as e:
+        logging.error('LLM cache setup failure: {}'.format(e))
+
+
+org_name = 'Post Consumer Brands'
+
+BRANDS = "Alpen Muesli, Barbara's, Better Oats, Bran Flakes, Coco Wheats, Disney100, Farina Mills, Golden Crisp, Grape-Nuts, Great Grains, Honey Bunches of Oats, Honey Maid S’mores, Honeycomb, Malt-O-Meal Hot, Malt-O-Meal, Mom's Best, Honey Ohs!, Oreo O’s, Pebbles, Premier Protein, Puffins, Raisin Bran, Shredded Wheat, Snoop Cereal, Sweet Dreams, Sweet Home Farm, Uncle Sam, Waffle Crisp, Weetabix"
 
-    "You are an expert customer support agent with excellent attention to detail. "
-    "You should ONLY use the information in 'Relevant Sources' section provided above while answering. "
+about_org = ("Post Consumer Brands sells only the following iconic breakfast cereals, snacks and pet food. "
+    f"The brands under PCB include: {BRANDS}.\n")
+
+# The system prompt is split so the static instructions form an identical prefix on every call, which
+# lets OpenAI's prompt caching reuse it; per-turn sources and chat history follow in a separate message.
+static_system_prompt_template = SystemMessagePromptTemplate.from_template(
+    template=
+    ("You are an expert customer support agent with excellent attention to detail. "
+    "You are given details about the organization, extracted parts of marketing documents and a question. "
+    "Read the following documents carefully. \n"
+    "You should ONLY use the information about the organization below and in the 'Relevant Sources' section provided after it while answering. "
     "DON'T use your prior knowledge to answer customer question. "
     "Always provide a short conversational answer with maximum clarity. "
     "When it comes to product related query I always want you to double check you're answering with correct product name and details. \n"
@@ -125,6 +246,19 @@ system_prompt_template = SystemMessagePromptTemplate.from_template(
 
     "\n=========\n"
 
+    "\nAbout the organization: \n"
+    f"{about_org}"),
+    input_variables=[]
+)
+
+system_prompt_template = SystemMessagePromptTemplate.from_template(
+    template=
+    ("\nRelevant Sources: \n"
+
+    "{context}"
+
+    "\n=========\n"
+
     "\nCurrent Chat: \n"
     "\n{chat_history}\n"),
     input_variables=['context','chat_history']
@@ -179,7 +313,7 @@ classification_template = PromptTemplate(
     template=(
     "You're a classification bot trained to redirect Post Consumer Brand (PCB)'s customer questions. "
     "Post Consumer Brands produce iconic breakfast cereals, snacks and pet food. "
-    "The brands under PCB include: Alpen Muesli, Barbara's, Better Oats, Bran Flakes, Coco Wheats, Disney100, Farina Mills, Golden Crisp, Grape-Nuts, Great Grains, Honey Bunches of Oats, Honey Maid S’mores, Honeycomb, Malt-O-Meal Hot, Malt-O-Meal, Mom's Best, Honey Ohs!, Oreo O’s, Pebbles, Premier Protein, Puffins, Raisin Bran, Shredded Wheat, Snoop Cereal, Sweet Dreams, Sweet Home Farm, Uncle Sam, Waffle Crisp, Weetabix."
+    f"The brands under PCB include: {BRANDS}. "
     "Classify the customer question into one of the following 4 classes and further into their "
     "subclasses if possible so that it can be answered by the correct department: \n\n"
 
@@ -206,20 +340,178 @@ classification_template = PromptTemplate(
 
 
 human_prompt_template = HumanMessagePromptTemplate.from_template(template = '{query}\nAI: ', input_variables = ['query'])
-chat_template = ChatPromptTemplate.from_messages([system_prompt_template,human_prompt_template])
+chat_template = ChatPromptTemplate.from_messages([static_system_prompt_template,system_prompt_template,human_prompt_template])
 hallucination_check = False
 model_name = os.getenv('GPT_3_MODEL')
-salesforce_client = salesforce_connect()
-vector_store = vector_search(database_name='knowledge',collection_name='products',index_name='searchindex')
-chatlog_collection = mongodb_collection(database_name='chat',collection_name='chatlog')
-flagged_response_collection = mongodb_collection(database_name='chat',collection_name='flagged_chat')
-llm = ChatOpenAI(model = model_name, temperature = 0)
-llm_chain = LLMChain(llm=llm, prompt=chat_template)
 
-org_name = 'Post Consumer Brands'
+# External clients are created lazily on first use (and memoized) so that importing this module,
+# e.g. at worker boot, performs no network I/O.
+_salesforce_lock = threading.Lock()
+_salesforce_session = {'client': None, 'expires': 0.0, 'retry_after': 0.0}
 
-about_org = ("Post Consumer Brands sells only the following iconic breakfast cereals, snacks and pet food. "
-    "The brands under PCB include: Alpen Muesli, Barbara's, Better Oats, Bran Flakes, Coco Wheats, Disney100, Farina Mills, Golden Crisp, Grape-Nuts, Great Grains, Honey Bunches of Oats, Honey Maid S’mores, Honeycomb, Malt-O-Meal Hot, Malt-O-Meal, Mom's Best, Honey Ohs!, Oreo O’s, Pebbles, Premier Protein, Puffins, Raisin Bran, Shredded Wheat, Snoop Cereal, Sweet Dreams, Sweet Home Farm, Uncle Sam, Waffle Crisp, Weetabix.\n")
+def get_salesforce() -> Optional[Salesforce]:
+    """
+    Returns the shared Salesforce client, logging in on first call and again once its session is
+    older than SF_SESSION_TTL seconds (default 3600). Returns None if Salesforce cannot be reached,
+    in which case no login is attempted for the next SF_LOGIN_RETRY_AFTER seconds (default 60).
+    """
+    with _salesforce_lock:
+        if _salesforce_session['client'] is None or time.monotonic() >= _salesforce_session['expires']:
+            if time.monotonic() < _salesforce_session['retry_after']:
+                return None
+            client = salesforce_connect()
+            if client is None:
+                _salesforce_session.update(client=None,
+                                           retry_after=time.monotonic()+int(os.getenv('SF_LOGIN_RETRY_AFTER', 60)))
+                return None
+            _salesforce_session.update(client=client, expires=time.monotonic()+int(os.getenv('SF_SESSION_TTL', 3600)))
+        return _salesforce_session['client']
+
+@functools.lru_cache(maxsize=1)
+def get_vector_store() -> MongoDBAtlasVectorSearch:
+    """Returns the shared vector store over the 'knowledge.products' collection."""
+    return vector_search(database_name='knowledge',collection_name='products',index_name='searchindex')
+
+@functools.lru_cache(maxsize=1)
+def get_chatlog_collection() -> Collection:
+    """Returns the MongoDB collection chat logs are written to."""
+    return mongodb_collection(database_name='chat',collection_name='chatlog')
+
+@functools.lru_cache(maxsize=1)
+def get_flagged_collection() -> Collection:
+    """Returns the MongoDB collection flagged responses are written to."""
+    return mongodb_collection(database_name='chat',collection_name='flagged_chat')
+
+@functools.lru_cache(maxsize=1)
+def get_semantic_cache_collection() -> Collection:
+    """Returns the MongoDB collection backing the semantic response cache, with its entries expiring."""
+    collection = mongodb_collection(database_name='chat',collection_name='semantic_cache')
+    semantic_cache.ensure_ttl_index(collection)
+    return collection
+
+@functools.lru_cache(maxsize=1)
+def get_llm() -> ChatOpenAI:
+    """Returns the shared chat model, installing the LLM cache on first call."""
+    setup_llm_caching()
+    return ChatOpenAI(model = model_name, temperature = 0)
+
+@functools.lru_cache(maxsize=1)
+def get_llm_chain() -> LLMChain:
+    """Returns the shared answer generation chain, which streams its tokens to the chain's callbacks."""
+    return LLMChain(llm=ChatOpenAI(model = model_name, temperature = 0, streaming = True), prompt=chat_template)
+
+# Token budget of the system prompt's organization details plus the retrieved sources
+MAX_CONTEXT_TOKENS = 3500
+
+@functools.lru_cache(maxsize=1)
+def get_about_org_tokens() -> int:
+    """Returns the number of tokens in the organization details, which take up part of the context budget."""
+    return calculate_tokens(about_org)
+
+# Chat logs are written in batches off the request path
+chatlog_batcher = ChatlogBatcher(get_chatlog_collection)
+
+# Responses are generated on their own pool while the request thread streams the tokens to the client
+_response_executor = ThreadPoolExecutor(max_workers=int(os.getenv('CHAT_WORKERS', 16)))
+
+def get_chat_response(user_prompt: str, session_id: str, username: str, callbacks: list = None) -> tuple[str, dict]:
+    """
+    Answers a user prompt from the semantic cache, or by running it through chat_response on a cache miss.
+
+    Parameters:
+        user_prompt (str): The prompt entered by the user.
+        session_id (str): The session ID associated with the prompt.
+        username (str): The username associated with the prompt.
+        callbacks (list): Optional. Callback handlers for the answer generation, e.g. to stream its tokens.
+
+    Returns:
+        tuple[str, dict]: The response text and the chat log document, which on a cache hit holds only the
+                          fields the chat history needs.
+
+    Example:
+        >>> get_chat_response("Tell me about Honey bunches cereal?", session_id, username)
+        ('Honey Bunches of Oats cereal is ...', {'text': 'Honey Bunches of Oats cereal is ...', ...})
+    """
+    # Deterministic (temperature 0) answers can be reused for semantically equivalent prompts. Prompts in an
+    # ongoing conversation may be follow-up questions, whose answers depend on it, so they bypass the cache.
+    use_semantic_cache = get_llm().temperature == 0 and not history.get_history(session_id, n=1,
+                                                                                 chatlog_collection=get_chatlog_collection())
+    chatbot_response = semantic_cache.get(user_prompt, collection=get_semantic_cache_collection(),
+                                          embeddings=embeddings) if use_semantic_cache else None
+    if chatbot_response is not None:
+        history.append(session_id, query=user_prompt, text=chatbot_response)
+        # Logged as a query turn so that the history still sees it when Redis is not configured or has expired it
+        return chatbot_response, {'query': user_prompt, 'text': chatbot_response, 'class': 'query',
+                                  'session_id': session_id, 'username': username,
+                                  'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+    assistant_response = chat_response(llm = get_llm(),llm_chain = get_llm_chain(),
+                                    vector_store = get_vector_store(), 
+                                    session_id = session_id,
+                                    query = user_prompt,
+                                    about_org = '', org_name = org_name, # about_org is part of the static system prompt
+                                    query_rewriter_template = query_rewriter_template,
+                                    hallucination_template = hallucination_template,
+                                    classification_template = classification_template,
+                                    chatlog_collection = get_chatlog_collection(),
+                                    flagged_response_collection = get_flagged_collection(),
+                                    system_about_org = about_org,
+                                    max_context_tokens = MAX_CONTEXT_TOKENS - get_about_org_tokens(),
+                                    embeddings = embeddings, callbacks = callbacks,
+                                    hallucination_check = hallucination_check, 
+                                    username = username, log = False)
+    chatbot_response = assistant_response['text']
+    # Only successfully generated answers to product and company queries are cached
+    if use_semantic_cache and assistant_response.get('class') in ('query', '1') and not assistant_response.get('error'):
+        semantic_cache.put(user_prompt, chatbot_response, collection=get_semantic_cache_collection(),
+                           embeddings=embeddings)
+    return chatbot_response, assistant_response
+
+CHAT_ERROR_MESSAGE = 'Something went wrong, please try again!'
+
+def chat_event_stream(session_id: str, username: str, user_prompt: str):
+    """
+    Generates the server-sent events for a chat turn: one 'delta' event per generated token, then '[DONE]'.
+    If the response could not be generated, an 'error' event replaces whatever was streamed before '[DONE]'.
+    The complete response is logged once it has been generated, even if the client disconnects.
+
+    Parameters:
+        session_id (str): The session ID associated with the prompt.
+        username (str): The username associated with the prompt.
+        user_prompt (str): The prompt entered by the user.
+
+    Example:
+        >>> StreamingHttpResponse(chat_event_stream(session_id, username, user_prompt), content_type='text/event-stream')
+    """
+    tokens = queue.Queue()
+
+    # The chat is logged from the worker, so it is kept even if the client disconnects mid-stream
+    def generate():
+        try:
+            chatbot_response, assistant_response = get_chat_response(user_prompt, session_id=session_id, username=username,
+                                                                     callbacks=[TokenQueueCallbackHandler(tokens)])
+        except Exception as e:
+            logging.error(f'CHAT_EVENT_STREAM: {e}')
+            chatbot_response, assistant_response = CHAT_ERROR_MESSAGE, None
+        finally:
+            tokens.put(None)
+        chatlog_batcher.put(chatlog(session_id=session_id, username=username, prompt=user_prompt, response=chatbot_response),
+                            assistant_response)
+        return chatbot_response, assistant_response is None or bool(assistant_response.get('error'))
+
+    future = _response_executor.submit(generate)
+    streamed = ''
+    while (token := tokens.get()) is not None:
+        streamed += token
+        yield f"data: {orjson.dumps({'delta': token}).decode()}\n\n"
+
+    chatbot_response, failed = future.result()
+    if failed:
+        yield f"data: {orjson.dumps({'error': CHAT_ERROR_MESSAGE}).decode()}\n\n"
+    # Cached and non-LLM responses produce no tokens, so they are sent in one piece
+    elif not streamed:
+        yield f"data: {orjson.dumps({'delta': chatbot_response}).decode()}\n\n"
+    yield 'data: [DONE]\n\n'
 
 
 ''' print("connection successful")
@@ -256,6 +548,8 @@ def login_user(request):
         user = authenticate(request, username=username, password=password)
         if user is not None:
             login(request, user)
+            # Group membership is looked up once per login instead of on every page render
+            request.session['is_admin'] = user.groups.filter(name='admins').exists()
             csrf_token = request.COOKIES.get('csrftoken')
             return redirect('signed')
         else:
@@ -278,41 +572,33 @@ def signed(request):
     else:
         if request.user.is_authenticated:
             is_superuser = request.user.is_superuser
-            group_name = request.user.groups.filter(name='admins').exists()
+            group_name = request.session.get('is_admin')
+            if group_name is None:
+                group_name = request.session['is_admin'] = request.user.groups.filter(name='admins').exists()
             return render(request, 'signedin.html', {'is_superuser': is_superuser, 'group_name': group_name})
         else:
             return redirect('login')
         
-def chatbot(request):
-    if not request.user.is_authenticated:
-        return redirect('login')
-    else:
-        if request.method=="POST":
-            request.session.create()
-            session_id = request.session.session_key
-            username = request.user.username
-
-            user_prompt= request.POST.get('prompt')
-            assistant_response = chat_response(llm = llm,llm_chain = llm_chain,
-                                            vector_store = vector_store, 
-                                            session_id = 'test-session',
-                                            query = user_prompt,
-                                            about_org = about_org, org_name = org_name,
-                                            query_rewriter_template = query_rewriter_template,
-                                            hallucination_template = hallucination_template,
-                                            classification_template = classification_template,
-                                            chatlog_collection = chatlog_collection,
-                                            hallucination_check = hallucination_check, 
-                                            username = 'testuser')
-            chatbot_response = assistant_response['text']
-            response_data = {
-                'user': user_prompt,
-                'bot': chatbot_response
-            }
-            print(chatbot_response)
-            # print(repr(chatbot_response))
-            new_chatlog = chatlog(session_id=session_id, username=username, prompt=user_prompt, response=chatbot_response)
-            new_chatlog.save()
-            
-            return JsonResponse(response_data)
-    return render(request, 'chatbot.html')
\ No newline at end of file
+class ChatbotView(LoginRequiredMixin, View):
+    """
+    Chat page (GET) and chat API (POST). The POST handler only ever returns the event stream,
+    and any other method is rejected with a 405 instead of rendering the page.
+    """
+    login_url = 'login'
+    redirect_field_name = None
+
+    def get(self, request):
+        return render(request, 'chatbot.html')
+
+    def post(self, request):
+        if not request.session.session_key:
+            request.session.save()
+        session_id = request.session.session_key
+        username = request.user.username
+
+        user_prompt= request.POST.get('prompt')
+        response = StreamingHttpResponse(chat_event_stream(session_id, username, user_prompt),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response